@@ -9,10 +9,26 @@ import os.path
 import resource
 import signal
 import sys
+import tempfile
 
 import util
 import vault
 
+# command name to expected positional args
+CMD_ARGS: Dict[str, List[str]] = {
+    'init':   ['vfname'],
+    'list':   [],
+    'set':    [],
+    'get':    ['credname'],
+    'search': ['substr'],
+    'remove': ['credname'],
+    'rekey':  [],
+}
+VALID_CMDS = sorted(CMD_ARGS.keys())
+
+# summary row for list and search, omits password
+ROW_FMT = '{:<20} - u={:<30} d={:<40} ({} days)\n'.format
+
 def parse_args() -> Tuple[str, Dict[str, str]]:
     """Parse command line args.
 
@@ -20,57 +36,42 @@ def parse_args() -> Tuple[str, Dict[str, str]]:
     are valid.  Terminates program otherwise.  Prints usage and terminate if no args
     given.
     """
-    cmd_args: Dict[str, List[str]] = {
-        'init':   ['vfname'],
-        'list':   [],
-        'set':    [],
-        'get':    ['credname'],
-        'search': ['substr'],
-        'remove': ['credname'],
-        'rekey':  [],
-    }
-    valid_cmds = sorted(cmd_args.keys())
-
     # must specify command
     if len(sys.argv) < 2:
         print(f'\nusage: {sys.argv[0]} [command] [args]\n')
-        for c in valid_cmds:
-            astr = ', '.join(f'<{v}>' for v in cmd_args[c])
+        for c in VALID_CMDS:
+            astr = ', '.join(f'<{v}>' for v in CMD_ARGS[c])
             print(f'    {c:<6} - {astr}')
         print()
         sys.exit(0)
 
     # command must be valid
     cmd = sys.argv[1]
-    if cmd not in valid_cmds:
-        print(f"\ninvalid command, expecting one of: {', '.join(valid_cmds)}\n")
+    if cmd not in CMD_ARGS:
+        print(f"\ninvalid command, expecting one of: {', '.join(VALID_CMDS)}\n")
         sys.exit(1)
 
     # correct command-specific arg count
     args_recv = len(sys.argv) - 2
-    args_want = len(cmd_args[cmd])
+    args_want = len(CMD_ARGS[cmd])
     if args_recv != args_want:
         print(f"\nincorrect arg count for '{cmd}': got={args_recv}, expected={args_want}\n")
-        astr = ', '.join(f'<{v}>' for v in cmd_args[cmd])
+        astr = ', '.join(f'<{v}>' for v in CMD_ARGS[cmd])
         print(f'    {cmd:<6} - {astr}\n')
         sys.exit(1)
 
-    return (cmd, dict(zip(cmd_args[cmd], sys.argv[2:])))
+    return (cmd, dict(zip(CMD_ARGS[cmd], sys.argv[2:])))
 
 
 def cmd_init(vfname: str) -> None:
     """Create new empty vault."""
-    while True:
-        vpass = util.get_password('vault key? ')
-        confirm = util.get_password('vault key? ')
-        if vpass == confirm:
-            break
-        print('\npasswords do not match\n')
+    salt = util.make_salt()
+    vpass = util.get_confirmed_password('vault key? ', salt)
 
     v = vault.Vault()
     try:
         with open(vfname, 'xb') as fp:
-            util.save_vault(fp, vpass, util.make_salt(), v)
+            util.save_vault(fp, vpass, salt, v)
     except FileExistsError:
         print('\nvault with that name already exists\n', file=sys.stderr)
         sys.exit(1)
@@ -84,84 +85,95 @@ def cmd_list(v: vault.Vault) -> None:
     """List vault contents."""
     print('\nVault contents')
     print('--------------')
-    for k in v.list():
-        cred = v.get(k)
-        age = (datetime.datetime.utcnow() - vault.parse_dt(cred['modified'])).days
-        print(f"{k:<20} - u={cred['username']:<30} d={cred['description']:<40} ({age} days)")
+    now = datetime.datetime.utcnow()
+    rows = []
+    for k, cred in v.items():
+        age = (now - vault.parse_dt(cred['modified'])).days
+        rows.append(ROW_FMT(k, cred['username'], cred['description'], age))
+    sys.stdout.writelines(rows)
     print('--------------')
 
 
-def cmd_set(vfname: str, vpass: bytes, salt: bytes, v: vault.Vault) -> None:
+def cmd_set(vfname: str, vpass: bytes, salt: bytes, fmt: int, v: vault.Vault) -> None:
     """Create or update vault entry."""
+    # older vaults get upgraded on save, stretch the new key during prompts
+    kdf = util.prefetch_key(vpass, salt) if fmt != util.FORMAT_CURRENT else None
     try:
         d = {}
         d['credname'] = input(f'{"credential:":<20}')
         d['username'] = input(f'{"username:":<20}')
 
-        while True:
-            d['password'] = util.get_password(f'{"password:":<20}').decode('utf-8')
-            pass_confirm = util.get_password(f'{"password:":<20}').decode('utf-8')
-            if d['password'] == pass_confirm:
-                break
-            print('\npasswords do not match\n')
+        d['password'] = util.get_confirmed_password(f'{"password:":<20}').decode('utf-8')
 
         d['description'] = input(f'{"description:":<20}')
 
     except EOFError:
         print('\ncancelled')
 
-    credname = d['credname']
-    if credname in v.list():
+    credname = d.pop('credname')
+    if credname in v:
         print(f'\nreplacing: {v.get(credname)}\n')
 
-    v.set(**d)
+    v.set_raw(credname, d)
+    if kdf is not None:
+        kdf.use()
     with open(vfname, 'wb') as fp:
         util.save_vault(fp, vpass, salt, v)
 
 
 def cmd_get(v: vault.Vault, credname: str) -> None:
     """Get vault entry."""
-    try:
-        cred = v.get(credname)
-        print(f"{credname:<20} - u={cred['username']} p={cred['password']} d={cred['description']}")
-    except KeyError:
+    if credname not in v:
         print('\ncredential not found\n')
+        return
+
+    cred = v.get(credname)
+    print(f"{credname:<20} - u={cred['username']} p={cred['password']} d={cred['description']}")
 
 
 def cmd_search(v: vault.Vault, substr: str) -> None:
     """Search vault credential names."""
     print('\nSearch results')
     print('---------------')
+    now = datetime.datetime.utcnow()
+    rows = []
     for k in v.search(substr):
         cred = v.get(k)
-        age = (datetime.datetime.utcnow() - vault.parse_dt(cred['modified'])).days
-        print(f"{k:<20} - u={cred['username']:<30} d={cred['description']:<40} ({age} days)")
+        age = (now - vault.parse_dt(cred['modified'])).days
+        rows.append(ROW_FMT(k, cred['username'], cred['description'], age))
+    sys.stdout.writelines(rows)
     print('---------------')
 
 
 def cmd_remove(vfname: str, vpass: bytes, salt: bytes, v: vault.Vault, credname: str) -> None:
     """Remove vault entry."""
-    try:
-        print(f'\nremoving: {v.get(credname)}\n')
-        v.remove(credname)
-        with open(vfname, 'wb') as fp:
-            util.save_vault(fp, vpass, salt, v)
-    except KeyError:
+    if credname not in v:
         print('credential not found')
+        return
 
+    print(f'\nremoving: {v.get(credname)}\n')
+    v.remove(credname)
+    with open(vfname, 'wb') as fp:
+        util.save_vault(fp, vpass, salt, v)
 
-def cmd_rekey(v: vault.Vault, vfname: str) -> None:
-    """Change secret key and salt on vault."""
-    while True:
-        newpass = util.get_password('new vault key? ')
-        confirm = util.get_password('new vault key? ')
-        if newpass == confirm:
-            break
-        print('\npasswords do not match\n')
 
+def cmd_rekey(vfname: str, vpass: bytes) -> None:
+    """Change secret key and salt on vault."""
     new_salt = util.make_salt()
-    with open(vfname, 'wb') as fp:
-        util.save_vault(fp, newpass, new_salt, v)
+    newpass = util.get_confirmed_password('new vault key? ', new_salt)
+
+    # write new vault alongside and swap it in, so a failure leaves the old file intact
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(vfname)))
+    try:
+        with os.fdopen(fd, 'wb') as fp_out, open(vfname, 'rb') as fp_in:
+            util.rekey_vault(fp_in, fp_out, vpass, newpass, new_salt)
+            fp_out.flush()
+            os.fsync(fp_out.fileno())
+        os.replace(tmpname, vfname)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+    util.forget_keys()
     print('vault key changed')
 
 
@@ -196,7 +208,7 @@ def main() -> None:
 
     try:
         with open(vfname, 'rb') as fp:
-            v, salt = util.load_vault(fp, vpass)
+            v, salt, fmt = util.load_vault(fp, vpass)
     except Exception as e:
         print(f'\nunable to load vault: {e}\n')
         sys.exit(1)
@@ -204,7 +216,7 @@ def main() -> None:
     if cmd == 'list':
         cmd_list(v)
     elif cmd == 'set':
-        cmd_set(vfname, vpass, salt, v)
+        cmd_set(vfname, vpass, salt, fmt, v)
     elif cmd == 'get':
         cmd_get(v, **args)
     elif cmd == 'search':
@@ -212,7 +224,7 @@ def main() -> None:
     elif cmd == 'remove':
         cmd_remove(vfname, vpass, salt, v, **args)
     elif cmd == 'rekey':
-        cmd_rekey(v, vfname)
+        cmd_rekey(vfname, vpass)
     else:
         raise RuntimeError('unhandled command')
 
@@ -1,5 +1,9 @@
+import contextlib
 import io
 import unittest
+from unittest import mock
+
+from cryptography import fernet
 
 import util
 import vault
@@ -12,6 +16,44 @@ class UtilTest(unittest.TestCase):
         self.assertEqual(len(s), 18)
         self.assertGreater(len(set(s)), 4)
 
+    def test_get_password(self):
+        # piped input is read line by line, prompting on stderr like getpass
+        stderr = io.StringIO()
+        with mock.patch('sys.stdin', io.StringIO('potato\ntomato\n')), \
+                contextlib.redirect_stderr(stderr):
+            self.assertEqual(util.get_password(), b'potato')
+            self.assertEqual(util.get_password('again: '), b'tomato')
+        self.assertEqual(stderr.getvalue(), 'Password: again: ')
+
+    def test_get_password_eof(self):
+        # exhausted input raises like getpass does
+        with contextlib.redirect_stderr(io.StringIO()):
+            with mock.patch('sys.stdin', io.StringIO('')):
+                self.assertRaises(EOFError, util.get_password)
+            with mock.patch('sys.stdin', io.StringIO('')):
+                self.assertRaises(EOFError, util.get_confirmed_password)
+            with mock.patch('sys.stdin', io.StringIO('potato\n')):
+                self.assertRaises(EOFError, util.get_confirmed_password)
+
+    def test_get_confirmed_password(self):
+        # retries until both entries match
+        entries = io.StringIO('potato\ntomato\npotato\npotato\n')
+        with mock.patch('sys.stdin', entries), contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(util.get_confirmed_password(), b'potato')
+
+        # only the confirmed password's key is handed on, others stay cached
+        util.forget_keys()
+        salt = util.make_salt()
+        util.encrypt(b'meowmix', salt, b'meow')
+        entries = io.StringIO('potato\ntomato\npotato\npotato\n')
+        with mock.patch('sys.stdin', entries), contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(util.get_confirmed_password(salt=salt), b'potato')
+        self.assertEqual(list(util._prefetched), [(b'potato', salt, util.FORMAT_CURRENT)])
+        self.assertEqual(util._cipher.cache_info().currsize, 1)
+        util.forget_keys()
+
     def test_encrypt_decrypt(self):
         # roundtrip to ensure we can recover original plaintext
         password = b'potato'
@@ -23,6 +65,32 @@ class UtilTest(unittest.TestCase):
 
         self.assertEqual(plain_text, deciphered_text)
 
+    def test_chunked(self):
+        # multi-chunk roundtrip, including empty input
+        password = b'potato'
+        salt = util.make_salt()
+        for plain_text in (b'', b'meow' * 40_000):
+            cipher_text = util.encrypt(password, salt, plain_text, util.FORMAT_GCM_CHUNKED)
+            deciphered_text = util.decrypt(password, salt, cipher_text, util.FORMAT_GCM_CHUNKED)
+            self.assertIsInstance(deciphered_text, bytes)
+            self.assertEqual(deciphered_text, plain_text)
+
+        # dropping the last chunk is caught
+        first_len = 4 + int.from_bytes(cipher_text[:4], 'big')
+        self.assertRaises(fernet.InvalidToken, util.decrypt, password, salt,
+                          cipher_text[:first_len], util.FORMAT_GCM_CHUNKED)
+
+    def test_decrypt_tampered(self):
+        # flipped ciphertext bit fails authentication
+        password = b'potato'
+        salt = util.make_salt()
+        cipher_text = bytearray(util.encrypt(password, salt, b'the cat meows'))
+        cipher_text[20] ^= 1
+        self.assertRaises(fernet.InvalidToken, util.decrypt, password, salt, bytes(cipher_text))
+
+        # truncated
+        self.assertRaises(fernet.InvalidToken, util.decrypt, password, salt, b'short')
+
     def test_save_load_vault(self):
         # dummy vault with data
         v = vault.Vault()
@@ -40,9 +108,10 @@ class UtilTest(unittest.TestCase):
 
         # load success: verify contents
         fp.seek(0)
-        out_v, out_salt = util.load_vault(fp, vpass)
+        out_v, out_salt, out_fmt = util.load_vault(fp, vpass)
 
         self.assertEqual(out_salt, salt)
+        self.assertEqual(out_fmt, util.FORMAT_CURRENT)
         self.assertEqual(out_v.dumps(), v.dumps())
 
         # load fail: corrupt salt
@@ -50,3 +119,83 @@ class UtilTest(unittest.TestCase):
         fp.write(b'a' * 18)
         fp.seek(0)
         self.assertRaises(RuntimeError, util.load_vault, fp, vpass)
+
+    def test_rekey_vault(self):
+        v = vault.Vault()
+        v.set('email', username='Niek Sanders', password='secret')
+        fp_in = io.BytesIO()
+        util.save_vault(fp_in, b'meowmix', util.make_salt(), v)
+        fp_in.seek(0)
+
+        # old key no longer opens it, new key and salt do
+        fp_out = io.BytesIO()
+        new_salt = util.make_salt()
+        util.rekey_vault(fp_in, fp_out, b'meowmix', b'purrito', new_salt)
+        fp_out.seek(0)
+        self.assertRaises(RuntimeError, util.load_vault, fp_out, b'meowmix')
+        fp_out.seek(0)
+        out_v, out_salt, out_fmt = util.load_vault(fp_out, b'purrito')
+        self.assertEqual(out_salt, new_salt)
+        self.assertEqual(out_v.dumps(), v.dumps())
+
+    def test_load_legacy_vault(self):
+        # pre-versioning files are bare salt followed by the token
+        v = vault.Vault()
+        v.set('email', username='Niek Sanders', password='secret')
+
+        vpass = b'meowmix'
+        salt = util.make_salt()
+        v_enc = util.encrypt(vpass, salt, v.dumps().encode(), util.FORMAT_LEGACY)
+        fp = io.BytesIO(salt + v_enc)
+
+        out_v, out_salt, out_fmt = util.load_vault(fp, vpass)
+        self.assertEqual(out_salt, salt)
+        self.assertEqual(out_fmt, util.FORMAT_LEGACY)
+        self.assertEqual(out_v.dumps(), v.dumps())
+
+        # saving upgrades to the current format
+        fp = io.BytesIO()
+        util.save_vault(fp, vpass, out_salt, out_v)
+        self.assertEqual(fp.getvalue()[:5], util.MAGIC + bytes([util.FORMAT_CURRENT]))
+
+    def test_load_unknown_format(self):
+        fp = io.BytesIO(util.MAGIC + bytes([255]) + util.make_salt() + b'junk')
+        self.assertRaises(RuntimeError, util.load_vault, fp, b'meowmix')
+
+    def test_derive_key(self):
+        # deterministic, 32 bytes, salt matters
+        salt = util.make_salt()
+        k1 = util.derive_key(b'potato', salt)
+        k2 = util.derive_key(b'potato', salt)
+        self.assertEqual(k1, k2)
+        self.assertEqual(len(k1), 32)
+        self.assertNotEqual(k1, util.derive_key(b'potato', util.make_salt()))
+
+    def test_cipher_cached(self):
+        # repeat encrypt/decrypt reuse the stretched key
+        util.forget_keys()
+        salt = util.make_salt()
+        cipher_text = util.encrypt(b'potato', salt, b'meow')
+        self.assertEqual(util.decrypt(b'potato', salt, cipher_text), b'meow')
+        self.assertEqual(util._cipher.cache_info().hits, 1)
+
+        # forgetting empties the cache
+        util.forget_keys()
+        self.assertEqual(util._cipher.cache_info().currsize, 0)
+
+    def test_prefetch_key(self):
+        # background derivation stays aside until used
+        util.forget_keys()
+        salt = util.make_salt()
+        kdf = util.prefetch_key(b'potato', salt)
+        kdf.join()
+        self.assertEqual(util._cipher.cache_info().currsize, 0)
+        self.assertEqual(util._prefetched, {})
+
+        # once used, the next cipher build skips stretching
+        kdf.use()
+        with mock.patch('util.derive_key') as derive_key:
+            util.encrypt(b'potato', salt, b'meow')
+        derive_key.assert_not_called()
+        self.assertEqual(util._prefetched, {})
+        util.forget_keys()
@@ -19,6 +19,21 @@ class TestVault(unittest.TestCase):
         ks = v.list()
         self.assertEqual(ks, ['a', 'b', 'c'], 'list not sorted')
 
+    def test_items(self):
+        # pairs sorted by credname
+        v = vault.Vault()
+        v.set('b', username='Bob')
+        v.set('a', username='Andy')
+        its = list(v.items())
+        self.assertEqual([k for k, _ in its], ['a', 'b'], 'items not sorted')
+        self.assertEqual(its[0][1]['username'], 'Andy')
+
+    def test_contains(self):
+        v = vault.Vault()
+        v.set('a', username='Andy')
+        self.assertIn('a', v)
+        self.assertNotIn('b', v)
+
     def test_set(self):
         # check auto-created datetime fields
         v = vault.Vault()
@@ -39,6 +54,16 @@ class TestVault(unittest.TestCase):
         self.assertEqual(d['created'], hack, 'created changed')
         self.assertNotEqual(d['modified'], hack, 'created unchanged')
 
+    def test_set_raw(self):
+        # caller's dict is copied, not adopted
+        v = vault.Vault()
+        data = {'username': 'Kim'}
+        v.set_raw('k', data)
+        self.assertEqual(v.get('k')['username'], 'Kim')
+        self.assertIn('modified', v.get('k'))
+        self.assertEqual(data, {'username': 'Kim'})
+        self.assertEqual(v.list(), ['k'])
+
     def test_get(self):
         # existing credential exists
         v = vault.Vault()
@@ -68,6 +93,11 @@ class TestVault(unittest.TestCase):
         self.assertEqual(v.search('oink'), [])
         # empty substr matches all
         self.assertEqual(v.search(''), ['meowmeow', 'meowmix', 'meowpurr', 'purrito'])
+        # mixed case names, removal
+        v.set('PurrPurr', username='Jane')
+        self.assertEqual(v.search('rpu'), ['PurrPurr'])
+        v.remove('meowpurr')
+        self.assertEqual(v.search('purr'), ['PurrPurr', 'purrito'])
 
     def test_remove(self):
         v = vault.Vault()
@@ -79,6 +109,10 @@ class TestVault(unittest.TestCase):
         # now you don't
         v.remove('j')
         self.assertRaises(KeyError, v.get, 'j')
+        self.assertEqual(v.list(), [])
+
+        # missing credential throws
+        self.assertRaises(KeyError, v.remove, 'j')
 
     def test_dump_load(self):
         # dump vault to string
@@ -1,56 +1,214 @@
 """
 Utility routines for vault manipulation.
 """
-from typing import Tuple, IO
+from typing import Dict, Optional, Tuple, Union, IO
 import base64
+import functools
 import getpass
-import hashlib
-import os
+import io
+import secrets
+import struct
+import sys
+import threading
 
 from cryptography import fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf import KeyDerivationFunction
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
 import vault
 
+# Vault files start with MAGIC and a format version byte.  Files lacking the
+# magic predate versioning and are read as FORMAT_LEGACY.
+MAGIC = b'pman'
+FORMAT_LEGACY = 0       # PBKDF2-HMAC-SHA256 2M rounds, Fernet; read only
+FORMAT_GCM_CHUNKED = 1  # scrypt N=2^17 r=8 p=1, AES256-GCM in 64 KiB chunks
+FORMAT_CURRENT = FORMAT_GCM_CHUNKED
+
+SALT_LEN = 18
+
 def get_password(prompt: str = 'Password: ') -> bytes:
-    """Prompt user for crypto password."""
+    """Prompt user for crypto password, reading piped input as a plain line."""
+    if not sys.stdin.isatty():
+        print(prompt, end='', file=sys.stderr, flush=True)
+        line = sys.stdin.readline()
+        if not line:
+            raise EOFError
+        return line.rstrip('\n').encode()
     return getpass.getpass(prompt).encode()
 
+def get_confirmed_password(prompt: str = 'Password: ', salt: Optional[bytes] = None) -> bytes:
+    """Prompt for password twice until both entries match."""
+    while True:
+        password = get_password(prompt)
+        kdf = prefetch_key(password, salt) if salt is not None else None
+        if get_password(prompt) == password:
+            break
+        print('\npasswords do not match\n')
+
+    if kdf is not None:
+        kdf.use()
+    return password
+
 def make_salt() -> bytes:
     """Generate a strong salt."""
-    return os.urandom(18)
+    return secrets.token_bytes(SALT_LEN)
+
+def derive_key(password: bytes, salt: bytes, fmt: int = FORMAT_CURRENT) -> bytes:
+    """Convert password into 32 byte vault key."""
+    kdf: KeyDerivationFunction
+    if fmt == FORMAT_LEGACY:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=2_000_000)
+    else:
+        kdf = Scrypt(salt=salt, length=32, n=2**17, r=8, p=1)
+    return kdf.derive(password)
+
+
+class _GcmChunked:
+    """AES256-GCM over length-prefixed 64 KiB chunks bound by index and last flag."""
+
+    CHUNK_LEN = 64 * 1024
+
+    def __init__(self, key: bytes) -> None:
+        """Set up AEAD for 32 byte key."""
+        self.aead = AESGCM(key)
+
+    def encrypt(self, data: bytes) -> bytes:
+        """Encrypt and authenticate, always emitting at least one chunk."""
+        n = max(1, -(-len(data) // self.CHUNK_LEN))
+        chunks = []
+        for i in range(n):
+            nonce = secrets.token_bytes(12)
+            piece = data[i * self.CHUNK_LEN:(i + 1) * self.CHUNK_LEN]
+            body = nonce + self.aead.encrypt(nonce, piece, struct.pack('>I?', i, i == n - 1))
+            chunks.append(struct.pack('>I', len(body)) + body)
+        return b''.join(chunks)
+
+    def decrypt(self, data: bytes) -> bytes:
+        """Verify and decrypt."""
+        return bytes(self.decrypt_from(io.BytesIO(data)))
+
+    def decrypt_from(self, fp: IO[bytes]) -> bytearray:
+        """Verify and decrypt chunks read from file into a single buffer."""
+        out = bytearray()
+        head = fp.read(4)
+        i = 0
+        while True:
+            if len(head) != 4:
+                raise fernet.InvalidToken
+            body = fp.read(struct.unpack('>I', head)[0])
+
+            # last chunk is the one not followed by another length
+            head = fp.read(4)
+            last = not head
+            try:
+                out += self.aead.decrypt(body[:12], body[12:], struct.pack('>I?', i, last))
+            except (InvalidTag, ValueError):
+                raise fernet.InvalidToken
+
+            if last:
+                return out
+            i += 1
 
-def derive_key(password: bytes, salt: bytes) -> bytes:
-    """Convert password into key for Fernet encryption."""
-    key = hashlib.pbkdf2_hmac('sha256', password, salt, 2_000_000)
-    return base64.urlsafe_b64encode(key)
 
-def encrypt(password: bytes, salt: bytes, data: bytes) -> bytes:
-    """Encrypt bytes using Fernet."""
-    key = derive_key(password, salt)
-    return fernet.Fernet(key).encrypt(data)
+# keys stretched ahead of time by KeyPrefetch.use(), claimed by _cipher
+_prefetched: Dict[Tuple[bytes, bytes, int], bytes] = {}
 
-def decrypt(password: bytes, salt: bytes, data: bytes) -> bytes:
-    """Decrypt bytes using Fernet."""
-    key = derive_key(password, salt)
-    return fernet.Fernet(key).decrypt(data)
+@functools.lru_cache(maxsize=8)
+def _cipher(password: bytes, salt: bytes, fmt: int) -> Union[fernet.Fernet, _GcmChunked]:
+    """Memoized cipher for password, salt and format version."""
+    key = _prefetched.pop((password, salt, fmt), None) or derive_key(password, salt, fmt)
+    if fmt == FORMAT_LEGACY:
+        return fernet.Fernet(base64.urlsafe_b64encode(key))
+    return _GcmChunked(key)
 
-def load_vault(fp: IO[bytes], vpass: bytes) -> Tuple[vault.Vault, bytes]:
-    """Load existing vault."""
-    salt = fp.read(18)
-    v_enc = fp.read()
+def forget_keys() -> None:
+    """Drop memoized ciphers and their derived keys."""
+    _cipher.cache_clear()
+    _prefetched.clear()
 
+
+class KeyPrefetch(threading.Thread):
+    """Daemon thread deriving a current format key, kept aside until used."""
+
+    def __init__(self, password: bytes, salt: bytes) -> None:
+        """Set up derivation for password and salt."""
+        super().__init__(daemon=True)
+        self.password = password
+        self.salt = salt
+        self.key = b''
+
+    def run(self) -> None:
+        """Derive the key."""
+        self.key = derive_key(self.password, self.salt, FORMAT_CURRENT)
+
+    def use(self) -> None:
+        """Wait for the key and hand it to the next matching encrypt or decrypt."""
+        self.join()
+        if self.key:
+            _prefetched[(self.password, self.salt, FORMAT_CURRENT)] = self.key
+
+
+def prefetch_key(password: bytes, salt: bytes) -> KeyPrefetch:
+    """Start deriving a current format key in the background."""
+    t = KeyPrefetch(password, salt)
+    t.start()
+    return t
+
+def encrypt(password: bytes, salt: bytes, data: bytes, fmt: int = FORMAT_CURRENT) -> bytes:
+    """Encrypt bytes for given format version."""
+    return _cipher(password, salt, fmt).encrypt(data)
+
+def decrypt(password: bytes, salt: bytes, data: bytes, fmt: int = FORMAT_CURRENT) -> bytes:
+    """Decrypt bytes for given format version, raising fernet.InvalidToken if invalid."""
+    return _cipher(password, salt, fmt).decrypt(data)
+
+def _read_vault(fp: IO[bytes], vpass: bytes) -> Tuple[Union[bytes, bytearray], bytes, int]:
+    """Read and decrypt vault file to (plaintext, salt, format version)."""
+    head = fp.read(len(MAGIC) + 1)
+    # a legacy salt starts with MAGIC only with odds of 2^-32
+    if head[:len(MAGIC)] == MAGIC:
+        fmt = head[-1]
+        salt = fp.read(SALT_LEN)
+    else:
+        fmt = FORMAT_LEGACY
+        salt = head + fp.read(SALT_LEN - len(head))
+
+    if fmt > FORMAT_CURRENT:
+        raise RuntimeError(f'unsupported vault format: {fmt}')
+
+    # chunked vaults are read and decrypted a chunk at a time
+    cipher = _cipher(vpass, salt, fmt)
     try:
-        v_raw = decrypt(vpass, salt, v_enc)
+        if isinstance(cipher, _GcmChunked):
+            return (cipher.decrypt_from(fp), salt, fmt)
+        return (cipher.decrypt(fp.read()), salt, fmt)
     except fernet.InvalidToken:
         raise RuntimeError('incorrect decryption key')
 
+def _write_vault(fp: IO[bytes], vpass: bytes, salt: bytes, v_raw: bytes) -> None:
+    """Encrypt plaintext and write vault file in current format version."""
+    v_enc = encrypt(vpass, salt, v_raw, FORMAT_CURRENT)
+    fp.writelines((MAGIC, bytes([FORMAT_CURRENT]), salt, v_enc))
+
+def load_vault(fp: IO[bytes], vpass: bytes) -> Tuple[vault.Vault, bytes, int]:
+    """Load existing vault, also returning its salt and format version."""
+    v_raw, salt, fmt = _read_vault(fp, vpass)
     v = vault.Vault()
-    v.loads(v_raw.decode('utf8'))
-    return (v, salt)
+    v.loads(v_raw)
+    return (v, salt, fmt)
 
 def save_vault(fp: IO[bytes], vpass: bytes, salt: bytes, v: vault.Vault) -> None:
-    """Save vault."""
-    v_raw = v.dumps().encode()
-    v_enc = encrypt(vpass, salt, v_raw)
-    fp.write(salt)
-    fp.write(v_enc)
+    """Save vault using the current format version."""
+    _write_vault(fp, vpass, salt, v.dumps().encode())
+
+def rekey_vault(fp_in: IO[bytes], fp_out: IO[bytes], old_pass: bytes, new_pass: bytes,
+                new_salt: bytes) -> None:
+    """Re-encrypt vault under new key and salt."""
+    kdf = prefetch_key(new_pass, new_salt)
+    v_raw, _, _ = _read_vault(fp_in, old_pass)
+    kdf.use()
+    _write_vault(fp_out, new_pass, new_salt, bytes(v_raw))
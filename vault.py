@@ -1,17 +1,18 @@
 """
 In-memory representation of credential vault.
 """
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Tuple, Union
+import bisect
 import datetime
 import json
 
 def current_dt() -> str:
     """Current UTC date and time as 'yyyy-mm-dd hh:mm:ss'."""
-    return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    return datetime.datetime.utcnow().isoformat(sep=' ', timespec='seconds')
 
 def parse_dt(dt: str) -> datetime.datetime:
     """Parse 'yyyy-mm-dd hh:mm:ss' to datetime."""
-    return datetime.datetime.strptime(dt, '%Y-%m-%d %H:%M:%S')
+    return datetime.datetime.fromisoformat(dt)
 
 
 class Vault:
@@ -22,17 +23,43 @@ class Vault:
     def __init__(self) -> None:
         """Create empty vault."""
         self.entries: Dict[str, Dict[str, Any]] = {}
+        # credential names kept in sorted order, with lowercased copies at the
+        # same positions for search
+        self._keys: List[str] = []
+        self._lower: List[str] = []
 
     def list(self) -> List[str]:
         """List vault contents."""
-        return sorted(self.entries.keys())
+        return list(self._keys)
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Yield vault entries as (credname, cred) pairs, sorted by credname."""
+        for k in self._keys:
+            yield k, self.entries[k]
+
+    def __contains__(self, credname: object) -> bool:
+        """Check if vault has entry."""
+        return credname in self.entries
 
     def set(self, credname: str, **data: str) -> None:
         """Set vault entry."""
+        # kwargs dict is already private to this call
+        self._put(credname, data)
+
+    def set_raw(self, credname: str, data: Dict[str, Any]) -> None:
+        """Set vault entry from dict of fields, which is copied."""
+        self._put(credname, dict(data))
+
+    def _put(self, credname: str, data: Dict[str, Any]) -> None:
+        """Stamp and store entry dict, taking ownership of it."""
         # keeps old created if overwriting existing entry
         now = current_dt()
         data['created'] = self.entries.get(credname, {}).get('created', now)
         data['modified'] = now
+        if credname not in self.entries:
+            i = bisect.bisect_left(self._keys, credname)
+            self._keys.insert(i, credname)
+            self._lower.insert(i, credname.lower())
         self.entries[credname] = data
 
     def get(self, credname: str) -> Dict[str, Any]:
@@ -42,16 +69,21 @@ class Vault:
     def search(self, credsubstr: str) -> List[str]:
         """Case-insensitive substring search of vault."""
         css_low = credsubstr.lower()
-        return sorted([k for k in self.entries if css_low in k.lower()])
+        return [k for k, k_low in zip(self._keys, self._lower) if css_low in k_low]
 
     def remove(self, credname: str) -> None:
         """Remove vault entry."""
         del self.entries[credname]
+        i = bisect.bisect_left(self._keys, credname)
+        del self._keys[i]
+        del self._lower[i]
 
     def dumps(self) -> str:
         """Serialize vault using JSON."""
         return json.dumps(self.entries)
 
-    def loads(self, s: str) -> None:
-        """Deserialize vault from JSON."""
+    def loads(self, s: Union[str, bytes, bytearray]) -> None:
+        """Deserialize vault from JSON text or UTF-8 bytes."""
         self.entries = json.loads(s)
+        self._keys = sorted(self.entries)
+        self._lower = [k.lower() for k in self._keys]